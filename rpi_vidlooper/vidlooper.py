@@ -4,38 +4,79 @@
 # Copyright (c) 2019 Alex Lubbock
 # License MIT
 
-import RPi.GPIO as GPIO
+import gpiod
+from gpiod.line import Bias, Direction, Edge, Value
+from datetime import timedelta
 import os
 import sys
-from subprocess import Popen, PIPE, call
+from subprocess import Popen, DEVNULL, call
 import time
-from threading import Lock
+import queue
 import signal
 import argparse
+import atexit
+import select
+import ctypes
+import errno
+import getpass
+import re
+
+try:
+    from jeepney import DBusAddress, DBusErrorResponse, new_method_call
+    from jeepney.io.blocking import open_dbus_connection
+    from jeepney.wrappers import unwrap_msg
+except ImportError:
+    open_dbus_connection = None
+
+# Terminal escape sequences
+_ANSI_CLEAR = '\x1b[2J\x1b[H'
+_ANSI_CURSOR_HIDE = '\x1b[?25l'
+_ANSI_CURSOR_SHOW = '\x1b[?25h'
+
+# GPIO spec for one video: INPUT or INPUT:OUTPUT pin numbers
+_PIN_RE = re.compile(r'^(\d+)(?::(\d+))?$')
+
+# Signals which stop the main loop
+_STOP_SIGNALS = frozenset({signal.SIGINT, signal.SIGTERM})
+
+# omxplayer's D-Bus endpoint, and the file where it writes its bus address
+_OMXPLAYER_DBUS_ADDRESS_FILE = '/tmp/omxplayerdbus.{}'
+_OMXPLAYER_DBUS_TIMEOUT = 0.5
+if open_dbus_connection is not None:
+    _OMXPLAYER_DBUS = DBusAddress('/org/mpris/MediaPlayer2',
+                                  bus_name='org.mpris.MediaPlayer2.omxplayer',
+                                  interface='org.mpris.MediaPlayer2.Player')
+
+# reboot(2) command to halt the system and power off
+_RB_POWER_OFF = 0x4321fedc
+
+
+def _pidfd_supported():
+    """ Check whether pidfd_open is available (Linux 5.3+, not filtered) """
+    if not hasattr(os, 'pidfd_open'):
+        return False
+    try:
+        os.close(os.pidfd_open(os.getpid()))
+    except OSError as e:
+        if e.errno in (errno.ENOSYS, errno.EPERM):
+            return False
+        raise
+    return True
 
 
 class _GpioParser(argparse.Action):
     """ Parse a GPIO spec string (see argparse setup later in this file) """
     def __call__(self, parser, namespace, values, option_string=None):
         gpio_dict = {}
-        pin_pairs = values.split(',')
-        for pair in pin_pairs:
-            pair_split = pair.split(':')
+        for pair in values.split(','):
+            m = _PIN_RE.match(pair.strip())
+            if not m:
+                raise ValueError('Invalid GPIO pin format: "{}". GPIO pins '
+                                 'must be numeric integers, as INPUT or '
+                                 'INPUT:OUTPUT'.format(pair))
 
-            if 0 == len(pair_split) > 2:
-                raise ValueError('Invalid GPIO pin format')
-
-            try:
-                in_pin = int(pair_split[0])
-            except ValueError:
-                raise ValueError('GPIO input pin must be numeric integer')
-
-            try:
-                out_pin = int(pair_split[1])
-            except ValueError:
-                raise ValueError('GPIO output pin must be numeric integer')
-            except IndexError:
-                out_pin = None
+            in_pin = int(m.group(1))
+            out_pin = int(m.group(2)) if m.group(2) else None
 
             if in_pin in gpio_dict:
                 raise ValueError('Duplicate GPIO input pin: {}'.format(in_pin))
@@ -46,8 +87,11 @@ class _GpioParser(argparse.Action):
 
 
 class VidLooper(object):
+    _GPIO_CHIP = '/dev/gpiochip0'
     _GPIO_BOUNCE_TIME = 200
-    _VIDEO_EXTS = ('.mp4', '.m4v', '.mov', '.avi', '.mkv')
+    _PRESS_REPEAT_TIME = 250
+    _PLAYER_POLL_INTERVAL = 0.5
+    _VIDEO_EXTS = frozenset({'.mp4', '.m4v', '.mov', '.avi', '.mkv'})
     _GPIO_PIN_DEFAULT = {
         26: 21,
         19: 20,
@@ -55,16 +99,20 @@ class VidLooper(object):
         6: 12
     }
 
-    # Use this lock to avoid multiple button presses updating the player
-    # state simultaneously
-    _mutex = Lock()
-
     # The currently playing video filename
     _active_vid = None
 
     # The process of the active video player
     _p = None
 
+    # The GPIO line request, for reading button presses and setting LEDs
+    _gpio = None
+
+    # Self-pipe used to wake up the main loop, e.g. when a video switch is
+    # requested
+    _wake_r = None
+    _wake_w = None
+
     def __init__(self, audio='hdmi', autostart=True, restart_on_press=False,
                  video_dir=os.getcwd(), videos=None, gpio_pins=None, loop=True,
                  no_osd=False, shutdown_pin=None, splash=None, debug=False):
@@ -73,6 +121,9 @@ class VidLooper(object):
             gpio_pins = self._GPIO_PIN_DEFAULT.copy()
         self.gpio_pins = gpio_pins
 
+        # Pins of video switches requested by switch_vid, for the main loop
+        self._events = queue.SimpleQueue()
+
         # Add shutdown pin
         self.shutdown_pin = shutdown_pin
 
@@ -80,16 +131,40 @@ class VidLooper(object):
         if videos:
             self.videos = videos
             for video in videos:
-                if not os.path.exists(video):
-                    raise FileNotFoundError('Video "{}" not found'.format(video))
+                try:
+                    os.stat(video)
+                except FileNotFoundError:
+                    raise FileNotFoundError(
+                        'Video "{}" not found'.format(video)) from None
         else:
-            self.videos = [os.path.join(video_dir, f)
-                           for f in sorted(os.listdir(video_dir))
-                           if os.path.splitext(f)[1] in self._VIDEO_EXTS]
+            with os.scandir(video_dir) as it:
+                self.videos = sorted(
+                    e.path for e in it
+                    if e.is_file() and
+                    os.path.splitext(e.name)[1].lower() in self._VIDEO_EXTS)
             if not self.videos:
                 raise Exception('No videos found in "{}". Please specify a different '
                                 'directory or filename(s).'.format(video_dir))
 
+        # Resolve video paths now, rather than on every video switch
+        self.videos = [os.path.abspath(v) for v in self.videos]
+
+        # Precompute pin lookups, to keep them out of the event loop. Input
+        # pins beyond the number of videos have no video, so aren't mapped.
+        self._in_pins = tuple(gpio_pins.keys())
+        video_pins = self._in_pins[:len(self.videos)]
+        self._pin_index = {p: i for i, p in enumerate(video_pins)}
+        self._out_pin_list = [o for o in gpio_pins.values() if o is not None]
+        self._leds_off = dict.fromkeys(self._out_pin_list, Value.INACTIVE)
+        self._led_values = {
+            pin: {o: Value.ACTIVE if i == pin else Value.INACTIVE
+                  for i, o in gpio_pins.items() if o is not None}
+            for pin in video_pins}
+
+        # Time of the last accepted press on each input pin
+        self._last_edge_ns = dict.fromkeys(video_pins, 0)
+        self._debounce_ns = self._PRESS_REPEAT_TIME * 1000000
+
         # Check that we have enough GPIO input pins for every video
         assert len(videos) <= len(self.gpio_pins), \
             "Not enough GPIO pins configured for number of videos"
@@ -106,110 +181,291 @@ class VidLooper(object):
         self.splash = splash
         self._splashproc = None
 
+        # Video player command, minus the video filename
+        self._cmd_prefix = ['omxplayer', '-b', '-o', self.audio] + \
+            (['--loop'] if self.loop else []) + \
+            (['--no-osd'] if self.no_osd else [])
+
+        # Make sure the terminal, GPIO pins and child processes are restored
+        # at exit, even if start() doesn't get to do it
+        atexit.register(self._cleanup)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._cleanup()
+        atexit.unregister(self._cleanup)
+
     def _kill_process(self):
         """ Kill a video player process. SIGINT seems to work best. """
         if self._p is not None:
-            os.killpg(os.getpgid(self._p.pid), signal.SIGINT)
+            # The player is a session leader, so its pid is its group ID
+            try:
+                os.killpg(self._p.pid, signal.SIGINT)
+            except ProcessLookupError:
+                # Already exited and reaped
+                pass
             self._p = None
 
+    def _player_running(self):
+        """ Check the video player is alive, without reaping it if not """
+        if self._p is None:
+            return False
+        try:
+            return os.waitid(os.P_PID, self._p.pid,
+                             os.WEXITED | os.WNOHANG | os.WNOWAIT) is None
+        except ChildProcessError:
+            return False
+
     def switch_vid(self, pin):
-        """ Switch to the video corresponding to the shorted pin """
-
-        # Use a mutex lock to avoid race condition when
-        # multiple buttons are pressed quickly
-        with self._mutex:
-            # Update the output pins' states
-            for in_pin, out_pin in self.gpio_pins.items():
-                if out_pin is not None:
-                    GPIO.output(out_pin,
-                                GPIO.HIGH if in_pin == pin else GPIO.LOW)
-
-            filename = self.videos[self.in_pins.index(pin)]
-            if filename != self._active_vid or self.restart_on_press:
-                # Kill any previous video player process
-                self._kill_process()
-                # Start a new video player process, capture STDOUT to keep the
-                # screen clear. Set a session ID (os.setsid) to allow us to kill
-                # the whole video player process tree.
-                cmd = ['omxplayer', '-b', '-o', self.audio]
-                if self.loop:
-                    cmd += ['--loop']
-                if self.no_osd:
-                    cmd += ['--no-osd']
-                self._p = Popen(cmd + [filename],
-                                stdout=None if self.debug else PIPE,
-                                preexec_fn=os.setsid)
-                self._active_vid = filename
+        """ Switch to the video corresponding to the shorted pin
+
+        This can be called from any thread; the switch is queued for the main
+        loop to carry out.
+        """
+        self._events.put(pin)
+        self._wake()
+
+    def _wake(self):
+        """ Wake the main loop """
+        if self._wake_w is not None:
+            try:
+                os.write(self._wake_w, b'\0')
+            except BlockingIOError:
+                # Pipe is full, main loop has a wake up pending anyway
+                pass
+
+    def _do_switch_vid(self, pin):
+        """ Switch to the video for pin. Only called from the main loop. """
+
+        # Ignore buttons which don't have a video
+        if pin not in self._pin_index:
+            return
+
+        # Drop repeated presses of the same button
+        now = time.monotonic_ns()
+        if now - self._last_edge_ns[pin] < self._debounce_ns:
+            return
+        self._last_edge_ns[pin] = now
+
+        filename = self.videos[self._pin_index[pin]]
+        if filename == self._active_vid and not self.restart_on_press:
+            return
+
+        # Update the output pins' states
+        if self._out_pin_list:
+            self._gpio.set_values(self._led_values[pin])
+
+        # Rewind the active video in place if possible, rather than
+        # restarting the video player
+        if filename == self._active_vid and self._rewind_player():
+            return
+
+        # Kill any previous video player process
+        self._kill_process()
+        # Start a new video player process, discard STDOUT and STDERR to keep
+        # the screen clear. Start a new session to allow us to kill the whole
+        # video player process tree.
+        self._p = Popen(self._cmd_prefix + [filename],
+                        stdout=None if self.debug else DEVNULL,
+                        stderr=None if self.debug else DEVNULL,
+                        start_new_session=True)
+        self._active_vid = filename
+
+    def _rewind_player(self):
+        """ Seek the active video player back to the start over D-Bus
+
+        Needs the optional jeepney package. Returns False if the player
+        couldn't be controlled, in which case it should be restarted instead.
+        """
+        if open_dbus_connection is None or not self._player_running():
+            return False
+
+        try:
+            with open(_OMXPLAYER_DBUS_ADDRESS_FILE.format(
+                    getpass.getuser())) as f:
+                bus = f.read().strip()
+            with open_dbus_connection(bus) as conn:
+                unwrap_msg(conn.send_and_get_reply(
+                    new_method_call(_OMXPLAYER_DBUS, 'SetPosition', 'ox',
+                                    ('/not/used', 0)),
+                    timeout=_OMXPLAYER_DBUS_TIMEOUT))
+        except (OSError, ValueError, DBusErrorResponse):
+            return False
+
+        return True
 
     @property
     def in_pins(self):
-        """ Create a tuple of input pins, for easy access """
-        return tuple(self.gpio_pins.keys())
+        """ Tuple of input pins, for easy access """
+        return self._in_pins
 
     def start(self):
         if not self.debug:
-            # Clear the screen
-            os.system('clear')
-            # Disable the (blinking) cursor
-            os.system('tput civis')
-
-        # Set up GPIO
-        GPIO.setmode(GPIO.BCM)
-        for in_pin, out_pin in self.gpio_pins.items():
-            GPIO.setup(in_pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-            if out_pin is not None:
-                GPIO.setup(out_pin, GPIO.OUT)
-                GPIO.output(out_pin, GPIO.LOW)
-
-        # Set up the shutdown pin
+            # Clear the screen and disable the (blinking) cursor
+            sys.stdout.write(_ANSI_CLEAR + _ANSI_CURSOR_HIDE)
+            sys.stdout.flush()
+
+        # Set up GPIO. Buttons short the input pins to ground, so watch for
+        # falling edges; the kernel handles debouncing.
+        in_pins = self._in_pins
         if self.shutdown_pin:
-            GPIO.setup(self.shutdown_pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-            GPIO.add_event_detect(self.shutdown_pin,
-                                  GPIO.FALLING,
-                                  callback=lambda _: call(['shutdown', '-h', 'now'], shell=False),
-                                  bouncetime=self._GPIO_BOUNCE_TIME)
-
-        if self.autostart:
-            if self.splash is not None:
-                self._splashproc = Popen(['fbi', '--noverbose', '-a',
-                                          self.splash])
-            else:
-                # Start playing first video
-                self.switch_vid(self.in_pins[0])
-
-        # Enable event detection on each input pin
-        for pin in self.in_pins:
-            GPIO.add_event_detect(pin, GPIO.FALLING, callback=self.switch_vid,
-                                  bouncetime=self._GPIO_BOUNCE_TIME)
-
-        # Loop forever
+            in_pins += (self.shutdown_pin, )
+        config = {
+            in_pins: gpiod.LineSettings(
+                direction=Direction.INPUT,
+                bias=Bias.PULL_UP,
+                edge_detection=Edge.FALLING,
+                debounce_period=timedelta(
+                    milliseconds=self._GPIO_BOUNCE_TIME))
+        }
+        if self._out_pin_list:
+            config[tuple(self._out_pin_list)] = gpiod.LineSettings(
+                direction=Direction.OUTPUT, output_value=Value.INACTIVE)
+        self._gpio = gpiod.request_lines(self._GPIO_CHIP,
+                                         consumer='rpi-vidlooper',
+                                         config=config)
+
+        # Set up the self-pipe before any video player can be started
+        self._wake_r, self._wake_w = os.pipe()
+        os.set_blocking(self._wake_w, False)
+
+        # Deliver SIGINT and SIGTERM through the self-pipe too, so the main
+        # loop exits and cleans up, rather than being interrupted mid-way
+        old_handlers = {sig: signal.signal(sig, lambda signum, frame: None)
+                        for sig in _STOP_SIGNALS}
+        old_wakeup_fd = signal.set_wakeup_fd(self._wake_w)
+
+        try:
+            if self.autostart:
+                if self.splash is not None:
+                    self._splashproc = Popen(['fbi', '--noverbose', '-a',
+                                              self.splash],
+                                             start_new_session=True)
+                else:
+                    # Start playing first video
+                    self._do_switch_vid(self.in_pins[0])
+
+            # Loop until stopped by a signal
+            self._event_loop()
+        finally:
+            signal.set_wakeup_fd(old_wakeup_fd)
+            for sig, handler in old_handlers.items():
+                signal.signal(sig, handler)
+            self._cleanup()
+
+    def _reset_player(self):
+        """ Reap the finished video player and switch off the LEDs """
+        self._p.wait()
+        if self._out_pin_list:
+            self._gpio.set_values(self._leds_off)
+        self._active_vid = None
+        self._p = None
+
+    def _player_exited(self, p):
+        """ Handle exit of video player p, unless it was already replaced """
+        if self._p is p:
+            self._reset_player()
+
+    def _handle_edge(self, pin):
+        """ Act on a button press """
+        if pin == self.shutdown_pin:
+            self._do_shutdown()
+        else:
+            self._do_switch_vid(pin)
+
+    def _do_shutdown(self):
+        """ Power off the system
+
+        Uses the reboot syscall directly, which needs CAP_SYS_BOOT. Without
+        it, falls back to asking the init system via the shutdown command.
+        """
+        os.sync()
+        libc = ctypes.CDLL('libc.so.6', use_errno=True)
+        if libc.reboot(_RB_POWER_OFF) < 0:
+            err = ctypes.get_errno()
+            if err != errno.EPERM:
+                raise OSError(err, os.strerror(err))
+            call(['shutdown', '-h', 'now'], shell=False)
+
+    def _event_loop(self):
+        """ Wait for button presses and (if not looping) player exits
+
+        Everything is multiplexed onto one epoll object: the GPIO line
+        request, the self-pipe (signalled for switch_vid requests and
+        signals), and a pidfd for the active video player. On kernels without
+        pidfd_open, the player is polled periodically instead. Returns on
+        SIGINT or SIGTERM.
+        """
+        watch_pidfd = not self.loop and _pidfd_supported()
+        if self.loop or watch_pidfd:
+            timeout = -1
+        else:
+            timeout = self._PLAYER_POLL_INTERVAL
+
+        epoll = select.epoll()
+        epoll.register(self._wake_r, select.EPOLLIN)
+        epoll.register(self._gpio.fd, select.EPOLLIN)
+        pidfd = None
+        watched = None
         try:
             while True:
-                time.sleep(0.5)
                 if not self.loop:
-                    pid = -1
-                    if self._p:
-                        pid = self._p.pid
-                        self._p.communicate()
-                    if self._p:
-                        if self._p.pid == pid:
-                            # Reset LEDs
-                            for out_pin in self.gpio_pins.values():
-                                if out_pin is not None:
-                                    GPIO.output(out_pin, GPIO.LOW)
-                            self._active_vid = None
-                            self._p = None
-
+                    p = self._p
+                    if p is not watched:
+                        if pidfd is not None:
+                            epoll.unregister(pidfd)
+                            os.close(pidfd)
+                            pidfd = None
+                        watched = p
+                        if watch_pidfd and watched is not None:
+                            pidfd = os.pidfd_open(watched.pid)
+                            epoll.register(pidfd, select.EPOLLIN)
+
+                for fd, _ in epoll.poll(timeout):
+                    if fd == self._wake_r:
+                        # Signal numbers are written here by the interpreter
+                        if not _STOP_SIGNALS.isdisjoint(
+                                os.read(self._wake_r, 512)):
+                            return
+                        # Carry out any video switches requested
+                        while True:
+                            try:
+                                pin = self._events.get_nowait()
+                            except queue.Empty:
+                                break
+                            self._do_switch_vid(pin)
+                    elif fd == self._gpio.fd:
+                        for event in self._gpio.read_edge_events():
+                            self._handle_edge(event.line_offset)
+                    elif fd == pidfd:
+                        epoll.unregister(pidfd)
+                        os.close(pidfd)
+                        pidfd = None
+                        self._player_exited(watched)
+
+                if not (self.loop or watch_pidfd) and watched is not None \
+                        and watched.poll() is not None:
+                    self._player_exited(watched)
         finally:
-            self.__del__()
+            if pidfd is not None:
+                os.close(pidfd)
+            epoll.close()
 
-    def __del__(self):
-        if not self.debug:
+    def _cleanup(self):
+        """ Restore the terminal and GPIO pins, and stop child processes """
+        if not self.debug and sys.stdout is not None:
             # Reset the terminal cursor to normal
-            os.system('tput cnorm')
+            sys.stdout.write(_ANSI_CURSOR_SHOW)
+            sys.stdout.flush()
 
-        # Cleanup the GPIO pins (reset them)
-        GPIO.cleanup()
+        # Switch off the LEDs and release the GPIO lines
+        if self._gpio is not None:
+            if self._out_pin_list:
+                self._gpio.set_values(self._leds_off)
+            self._gpio.release()
+            self._gpio = None
 
         # Kill any active video process
         self._kill_process()
@@ -217,6 +473,13 @@ class VidLooper(object):
         # Kill any active splash screen
         if self._splashproc:
             os.killpg(os.getpgid(self._splashproc.pid), signal.SIGKILL)
+            self._splashproc = None
+
+        # Close the self-pipe
+        if self._wake_r is not None:
+            os.close(self._wake_r)
+            os.close(self._wake_w)
+            self._wake_r = self._wake_w = None
 
 
 def main():
@@ -278,19 +541,18 @@ Raspberry Pi, which must be installed separately.
     args = parser.parse_args()
 
     # Apply any countdown
-    countdown = args.countdown
+    msgs = ['\rrpi-vidlooper starting in {} seconds '
+            '(Ctrl-C to abort)...'.format(i).encode()
+            for i in range(args.countdown, 0, -1)]
 
-    while countdown > 0:
-        sys.stdout.write(
-            '\rrpi-vidlooper starting in {} seconds '
-            '(Ctrl-C to abort)...'.format(countdown))
-        sys.stdout.flush()
+    for msg in msgs:
+        os.write(sys.stdout.fileno(), msg)
         time.sleep(1)
-        countdown -= 1
 
     del args.countdown
 
-    VidLooper(**vars(args)).start()
+    with VidLooper(**vars(args)) as vidlooper:
+        vidlooper.start()
 
 
 if __name__ == '__main__':
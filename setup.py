@@ -16,7 +16,9 @@ def main():
         author='Alex Lubbock',
         author_email='code@alexlubbock.com',
         packages=find_packages(),
-        install_requires=['RPi.GPIO'],
+        install_requires=['gpiod>=2.0'],
+        extras_require={'dbus': ['jeepney>=0.7']},
+        python_requires='>=3.9',
         cmdclass=versioneer.get_cmdclass(),
         zip_safe=True,
         entry_points = {